@@ -1,11 +1,24 @@
 import requests
-from libraries.utils import default_logger
+from requests.adapters import HTTPAdapter
+import asyncio
+import httpx
+from libraries.utils import (default_logger, retry_on_rate_limit, load_country_config, fast_normalize,
+                             flatten_newlines, parse_graph_datetime, parse_json, graph_get,
+                             get_with_page_limit, get_json_async, get_with_page_limit_async, GRAPH_API_URL)
 from libraries.bq_utils import save_table
 import pandas as pd
-import json
-import traceback
+import numpy as np
+from itertools import chain
 import os
-import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Every field is kept by fn_clean_data
+_MEDIA_FIELDS = ("id,comments_count,permalink,media_type"
+                 ",like_count,ig_id,timestamp,caption,is_shared_to_feed,media_product_type")
+_COMMENT_FIELDS = ("hidden,id,like_count,text,timestamp,username"
+                   ",replies.limit(100){hidden,id,like_count,text,timestamp,username,parent_id}")
+# Columns of df_comments, after renaming the fields of _COMMENT_FIELDS
+_COMMENT_COLUMNS = ['id', 'created_time', 'hidden', 'like_count', 'message', 'username', 'replies', 'media_id']
 
 class InstragramMedia:
     """
@@ -38,17 +51,7 @@ class InstragramMedia:
                         the specified country is not in the configuration.
         """
 
-        # Obtén la configuración del país desde la variable de entorno codificada en Base64
-        encoded_config = os.getenv("META_COUNTRY_CONFIG")
-        
-        if not encoded_config:
-            raise ValueError("META_COUNTRY_CONFIG environment variable is missing.")
-        
-        # Decodifica la configuración
-        decoded_config = base64.b64decode(encoded_config).decode()
-        
-        # Convierte el JSON decodificado en un diccionario
-        country_config = json.loads(decoded_config)
+        country_config = load_country_config()
 
         # Verifica si el país está en la configuración
         if country not in country_config:
@@ -62,12 +65,30 @@ class InstragramMedia:
         self.page_id = config.get("page_id")
         self.country = country
 
+        # Keep-alive connections reused by every request to the Instagram API
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0))
+
         default_logger.info(f"\tCountry set with {self.country}")
 
         self.df_media_items = pd.DataFrame()
-        self.df_comments = pd.DataFrame()
+        self.df_comments = pd.DataFrame(columns=_COMMENT_COLUMNS)
         self.df_replies = pd.DataFrame()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the HTTP session used to call the Instagram API.
+        """
+
+        self._session.close()
+
+    @retry_on_rate_limit(max_retries=5, initial_backoff=60)
     def get_media_items(self, paging_url = None):
         """
         Fetches media items data from Instagram API.
@@ -83,21 +104,20 @@ class InstragramMedia:
         """
 
         if paging_url:
-            response = requests.get(paging_url)
+            response = graph_get(self._session, paging_url)
 
         else:
 
             url = f'https://graph.facebook.com/v20.0/{self.ig_business_account_id}/media'
+            # The page size is picked by get_with_page_limit
             params = {"access_token" : self.access_token
-                      ,"fields": ("fields=id,comments_count,permalink,media_type"
-                                  ",like_count,ig_id,timestamp,caption,is_shared_to_feed,media_product_type")
-                      ,"limit": 100
+                      ,"fields": _MEDIA_FIELDS
             }
             
-            response = requests.get(url, params=params)
+            response = get_with_page_limit(self._session, url, params)
 
         response.raise_for_status()
-        return response.json()
+        return parse_json(response)
     
     def get_all_media_items(self):
         """
@@ -112,22 +132,22 @@ class InstragramMedia:
         try:
 
             first_response = self.get_media_items()
-            media_items.extend(f for f in first_response['data'])
+            media_items.extend(first_response['data'])
             url = first_response.get('paging', {}).get('next')
 
             while url:
 
                 response = self.get_media_items(paging_url=url)
-                media_items.extend(f for f in response['data'])
+                media_items.extend(response['data'])
                 url = response.get('paging', {}).get('next')
                 page += 1
 
                 """ if page == 10:
                     break """
 
-            df = pd.json_normalize(media_items)
-            df = df.sort_values(by='timestamp', ascending=False)
-            df["caption"] = df["caption"].str.replace("\n", ' ')
+            # Media items come back flat, no flattening needed
+            df = pd.DataFrame.from_records(media_items)
+            df["caption"] = flatten_newlines(df["caption"])
 
             default_logger.info(f"\tMedia items Dataframe's shape {df.shape}")
 
@@ -138,88 +158,109 @@ class InstragramMedia:
         except requests.exceptions.HTTPError as http_error:
             
             if http_error.response is not None:
-                error_info = http_error.response.json()
-                default_logger.error(json.dumps(error_info, indent=2))
+                default_logger.error("\tGraph error: %r", parse_json(http_error.response))
 
-        except Exception as err:
+        except Exception:
             
-            default_logger.error(f"Other error occured {err}")
+            default_logger.exception("\tMedia items fetch failed")
 
-    def get_comments(self, media_id = None, paging_url = None):
+    def get_comments_params(self):
         """
-        Fetches comments data from Instagram API for a given media item.
-
-        Args:
-            media_id (str, optional): The media item ID to fetch comments for.
-            paging_url (str, optional): URL to fetch the next page of results.
+        Builds the query parameters used to fetch the comments of a media item.
 
         Returns:
-            dict: The JSON response from the Instagram API.
-
-        Raises:
-            requests.exceptions.HTTPError: If the HTTP request fails.
+            dict: The query parameters for the comments edge of the Instagram API.
         """
 
-        if paging_url:
-            url = paging_url
-        else:
-            url = f"https://graph.facebook.com/v20.0/{media_id}/comments"
-
-        params = {
+        return {
             "access_token": self.access_token,
-            "fields": (
-                "hidden,id,like_count,text,timestamp,username"
-                ",replies.limit(100){hidden,id,like_count,text,timestamp,username,parent_id}"
-            ),
-            "limit": 100,
+            "fields": _COMMENT_FIELDS,
         }
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        return response.json()
-    
-    def get_all_comments(self):
+
+    async def _get_comments_async(self, session, semaphore, media_id):
         """
-        Retrieves all comments for media items and stores them in a DataFrame.
+        Fetches every page of comments of a media item.
+
+        Args:
+            session (httpx.AsyncClient): The HTTP/2 client shared by all the requests.
+            semaphore (asyncio.Semaphore): Caps how many media items are paginated at the same time.
+            media_id (str): The media item ID to fetch comments for.
+
+        Returns:
+            list: The comments of the media item as returned by the Instagram API. When a
+                  page fails, the comments of the pages before it.
         """
 
-        default_logger.info(f"\tTrying to get all media comments")
+        comments = []
 
-        try:
+        async with semaphore:
+            try:
+                response = await get_with_page_limit_async(session, f"{GRAPH_API_URL}/{media_id}/comments",
+                                                           self.get_comments_params())
 
-            comments = []
+                while response:
+                    comments.extend(response["data"])
 
-            for media in self.df_media_items.itertuples():
-                media_id = media.id
+                    # A paging url already carries the whole query string
+                    url = response.get("paging", {}).get("next")
+                    response = await get_json_async(session, url) if url else None
 
-                if media.comments_count != 0:
+            except httpx.HTTPError as http_error:
+                default_logger.error("Error in media_id: %s, the error was %s", media_id, http_error)
 
-                    page = 1
-                    # default_logger.info(f"\tIterating in all media ... media_id: {media_id}, page: {page}")
-                    first_response = self.get_comments(media_id=media_id)
+            except Exception:
+                # Raising would make gather cancel the comments of every other media item
+                default_logger.exception("Error in media_id: %s", media_id)
 
-                    for c in first_response["data"]:
-                        c['media_id'] = media_id
-                        comments.append(c) 
-                    url = first_response.get("paging", {}).get("next")
+        return comments
 
-                    while url:
-                        page += 1
-                        response = self.get_comments(paging_url=url)
-                        for c in response["data"]:
-                            c['media_id'] = media_id
-                            comments.append(c) 
-                        url = response.get("paging", {}).get("next")
-                        # default_logger.info(f"\tIterating in all media ... media_id: {media_id}, page: {page}")
+    async def _get_all_comments_async(self, media_ids, max_concurrency=16):
+        """
+        Fetches the comments of all the given media items concurrently.
+
+        Args:
+            media_ids (list): The media item IDs to fetch comments for.
+            max_concurrency (int, optional): Maximum number of media items paginated at the same time.
+
+        Returns:
+            list: One (media_id, comments) tuple per media item.
+        """
 
+        semaphore = asyncio.Semaphore(max_concurrency)
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
 
-            df = pd.json_normalize(comments)
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=30) as session:
+            results = await asyncio.gather(*[self._get_comments_async(session, semaphore, media_id)
+                                             for media_id in media_ids])
 
-            df.rename(columns={'timestamp': 'created_time'
-                               ,'text': 'message'
-                               ,'replies.data': 'replies'}, inplace=True)
-            
-            df['message'] = df['message'].str.replace('\n', ' ')
-            df = df.sort_values("created_time", ascending=False)
+        return list(zip(media_ids, results))
+
+    def get_all_comments(self):
+        """
+        Retrieves all comments for media items, paginating the media items concurrently,
+        and stores them in a DataFrame.
+        """
+
+        default_logger.info(f"\tTrying to get all media comments")
+
+        try:
+
+            media_ids = self.df_media_items.loc[self.df_media_items['comments_count'] != 0, 'id'].tolist()
+            pages = asyncio.run(self._get_all_comments_async(media_ids))
+
+            # replies.data is kept as the raw list of replies for fn_extract_replies
+            df = fast_normalize(list(chain.from_iterable(comments for _, comments in pages)))
+            # media_id is repeated once per comment instead of being written into every dict
+            df['media_id'] = np.repeat([media_id for media_id, _ in pages],
+                                       [len(comments) for _, comments in pages])
+
+            # Every column is kept even when no comment has it, e.g. no comment has replies
+            df = (df.rename(columns={'timestamp': 'created_time'
+                                     ,'text': 'message'
+                                     ,'replies.data': 'replies'})
+                    .reindex(columns=_COMMENT_COLUMNS))
+
+            df['message'] = flatten_newlines(df['message'])
 
             # df.to_csv("results/ig_principal_comments.csv", index=False, encoding='utf-8')
 
@@ -227,14 +268,8 @@ class InstragramMedia:
 
             default_logger.info(f"\tComments Dataframe's shape {self.df_comments.shape}")
 
-        except requests.exceptions.HTTPError as http_error:
-            if http_error.response is not None:
-                error_info = http_error.response.json()
-                default_logger.error(json.dumps(error_info, indent=2))
-
-        except Exception as err:
-            default_logger.error(f"Other error occurred: {err}")  # Otros errores
-            default_logger.error(traceback.format_exc())
+        except Exception:
+            default_logger.exception("\tComment fetch failed")  # Otros errores
 
     def fn_extract_replies(self):
         """
@@ -243,26 +278,17 @@ class InstragramMedia:
 
         default_logger.info(f"\tExtracting replies")
 
-        df_filtered = self.df_comments[self.df_comments['replies'].notnull()]
-
-        replies = [
-            {
-                'comment_parent_id': sc.get('parent_id'),
-                'id': sc.get('id'),
-                'created_time': sc.get('timestamp'),
-                'hidden': sc.get('hidden'),
-                'like_count': sc.get('like_count'),
-                'message': sc.get('text'),
-                'username': sc.get('username'),
-            }
-            for row in df_filtered.itertuples()
-            for sc in row.replies
-        ]
+        # One row per reply, an empty replies list explodes to NaN and is dropped
+        replies = self.df_comments['replies'].dropna().explode().dropna()
 
-        self.df_replies = pd.DataFrame(replies)
+        self.df_replies = (pd.DataFrame(replies.tolist())
+                           .rename(columns={'parent_id': 'comment_parent_id'
+                                            ,'timestamp': 'created_time'
+                                            ,'text': 'message'})
+                           .reindex(columns=['comment_parent_id', 'id', 'created_time', 'hidden',
+                                             'like_count', 'message', 'username']))
 
-        self.df_replies['message'] = self.df_replies['message'].str.replace('\n',' ')
-        self.df_replies["created_time"] = pd.to_datetime(self.df_replies["created_time"])
+        self.df_replies['message'] = flatten_newlines(self.df_replies['message'])
 
         default_logger.info(f"\tReplies Dataframe's shape {self.df_replies.shape}")
 
@@ -281,39 +307,50 @@ class InstragramMedia:
         default_logger.info("\tCleaning data")
 
         # df_media_items section
-        self.df_media_items.rename(columns={'timestamp': 'created_time'
-                                    ,"permalink": "url"}, inplace=True)
-        self.df_media_items["created_time"] = pd.to_datetime(self.df_media_items["created_time"])
-        
-        columns = ['caption', 'ig_id', 'url', 'media_type', 'media_product_type', 'id']
-        self.df_media_items[columns] = self.df_media_items[columns].astype("string")
-
-        columns = ['comments_count', 'like_count']
-        self.df_media_items[columns] = self.df_media_items[columns].astype("int")
+        self.df_media_items = (self.df_media_items
+                               .rename(columns={'timestamp': 'created_time'
+                                                ,"permalink": "url"})
+                               .astype({"caption": "string",
+                                        "ig_id": "string",
+                                        "url": "string",
+                                        "media_type": "string",
+                                        "media_product_type": "string",
+                                        "id": "string",
+                                        "comments_count": "int64",
+                                        "like_count": "int64",
+                                        "is_shared_to_feed": "bool"})
+                               # Only a handful of distinct values, stored dictionary encoded. Casting from
+                               # string keeps string categories, so Parquet gets string values even when empty
+                               .astype({"media_type": "category",
+                                        "media_product_type": "category"})
+                               .assign(created_time=lambda df: parse_graph_datetime(df["created_time"]))
+                               .drop_duplicates(subset=['id']))
 
-        self.df_media_items['is_shared_to_feed'] = self.df_media_items['is_shared_to_feed'].astype("bool")
-        self.df_media_items.drop_duplicates(inplace=True)
-        
         # df_comments section
-
-        self.df_comments["created_time"] = pd.to_datetime(self.df_comments["created_time"])
-
-        columns = ['id', 'message', 'username', 'media_id']
-        self.df_comments[columns] = self.df_comments[columns].astype("string")
-
-        self.df_comments['like_count'] = self.df_comments['like_count'].astype("int")
-        self.df_comments['hidden'] = self.df_comments['hidden'].astype("bool")
-        self.df_comments.drop_duplicates(inplace=True)
+        self.df_comments = (self.df_comments
+                            .astype({"id": "string",
+                                     "message": "string",
+                                     "username": "string",
+                                     "media_id": "string",
+                                     "like_count": "int64",
+                                     "hidden": "bool"})
+                            # Repeated once per comment, stored dictionary encoded with string categories
+                            .astype({"username": "category",
+                                     "media_id": "category"})
+                            .assign(created_time=parse_graph_datetime(self.df_comments["created_time"]))
+                            .drop_duplicates(subset=['id']))
 
         # df_replies section
-        self.df_replies["created_time"] = pd.to_datetime(self.df_replies["created_time"])
-
-        columns = ['comment_parent_id', 'message', 'username', 'id']
-        self.df_replies[columns] = self.df_replies[columns].astype("string")
-
-        self.df_replies['like_count'] = self.df_replies['like_count'].astype("int")
-        self.df_replies['hidden'] = self.df_replies['hidden'].astype("bool")
-        self.df_replies.drop_duplicates(inplace=True)
+        self.df_replies = (self.df_replies
+                           .astype({"comment_parent_id": "string",
+                                    "message": "string",
+                                    "username": "string",
+                                    "id": "string",
+                                    "like_count": "int64",
+                                    "hidden": "bool"})
+                           .astype({"username": "category"})
+                           .assign(created_time=parse_graph_datetime(self.df_replies["created_time"]))
+                           .drop_duplicates(subset=['id']))
 
     def fn_save_data(self):
         """
@@ -334,9 +371,19 @@ class InstragramMedia:
         TABLE_NAME_MEDIA_REPLIES = f'{self.country}_instragram_media_replies'
 
         try:
-            save_table(df=self.df_media_items, project=PROJECT, dataset=DATASET, table_name=TABLE_NAME_MEDIA)
-            save_table(df=self.df_comments, project=PROJECT, dataset=DATASET, table_name=TABLE_NAME_MEDIA_COMMENTS)
-            save_table(df=self.df_replies, project=PROJECT, dataset=DATASET, table_name=TABLE_NAME_MEDIA_REPLIES)
+            # Each load job mostly waits on BigQuery, so the three of them run at the same time
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                futures = {
+                    executor.submit(save_table, df=self.df_media_items, project=PROJECT, dataset=DATASET, table_name=TABLE_NAME_MEDIA): TABLE_NAME_MEDIA,
+                    executor.submit(save_table, df=self.df_comments, project=PROJECT, dataset=DATASET, table_name=TABLE_NAME_MEDIA_COMMENTS): TABLE_NAME_MEDIA_COMMENTS,
+                    executor.submit(save_table, df=self.df_replies, project=PROJECT, dataset=DATASET, table_name=TABLE_NAME_MEDIA_REPLIES): TABLE_NAME_MEDIA_REPLIES,
+                }
+
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as err:
+                        default_logger.error(f"\tError saving {futures[future]}: {err}")  # Otros errores
 
         except Exception as err:
                 default_logger.error(f"\tError saving data: {err}")  # Otros errores
\ No newline at end of file
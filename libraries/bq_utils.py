@@ -1,13 +1,16 @@
 """Libraries for google.cloud"""
 
+import io
 import json
 import os
+import threading
+from functools import lru_cache
 from google.cloud import bigquery
-from google.cloud.bigquery import LoadJobConfig
+from google.cloud.bigquery import LoadJobConfig, SourceFormat
 from libraries.utils import get_secrets_sellers
 
 
-dict_credentials = get_secrets_sellers().get("bigquery")
+_credentials_lock = threading.Lock()
 
 
 def save_dict_to_json_file(dictionary: dict, file_name: str) -> str:
@@ -18,14 +21,25 @@ def save_dict_to_json_file(dictionary: dict, file_name: str) -> str:
     return file_name
 
 
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = save_dict_to_json_file(
-        dict_credentials,
-        "file.json"
-    )
+@lru_cache(maxsize=1)
+def ensure_credentials() -> str:
+    """Write the bigquery credentials to file.json the first time a client is needed, not on import"""
 
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = save_dict_to_json_file(
+            get_secrets_sellers().get("bigquery"),
+            "file.json"
+        )
 
+    return os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
+
+
+@lru_cache(maxsize=4)
 def get_bq_client(project):
-    """Get client by project"""
+    """Get client by project, cached so every save reuses its credentials and connections"""
+
+    # Saves run in threads, only the first one writes file.json
+    with _credentials_lock:
+        ensure_credentials()
 
     return bigquery.Client(project=project)
 
@@ -34,11 +48,14 @@ def get_bg_config(project, data_types_schema, write_disposition, autodetect):
     """Configure project and write disposition"""
 
     __client_bg = get_bq_client(project)
-    __job_config = LoadJobConfig(schema=data_types_schema,
-                                 write_disposition=write_disposition,
+    __job_config = LoadJobConfig(write_disposition=write_disposition,
                                  autodetect=autodetect
                             )
 
+    # An empty schema is rejected by the load job, without one BigQuery uses the file's
+    if data_types_schema:
+        __job_config.schema = data_types_schema
+
     return __client_bg, __job_config
 
 
@@ -46,16 +63,41 @@ def save_table(df,
                project,
                dataset,
                table_name,
-               data_types_schema=[],
-               write_disposition='WRITE_TRUNCATE',
-               autodetect=True
+               data_types_schema=None,
+               write_disposition='WRITE_TRUNCATE'
             ):
-    """Save df to biguquery table"""
-    __client_bg, __job_config = get_bg_config(project, data_types_schema, write_disposition, autodetect)
+    """Save df to biguquery table through an in-memory snappy Parquet file"""
+    # Parquet carries its own schema, so BigQuery has nothing left to autodetect
+    __client_bg, __job_config = get_bg_config(project, data_types_schema, write_disposition, autodetect=False)
+    __job_config.source_format = SourceFormat.PARQUET
+
+    buffer = io.BytesIO()
+    # Timestamps in microseconds, as load_table_from_dataframe used to send them
+    df.to_parquet(buffer, engine='pyarrow', compression='snappy', index=False,
+                  coerce_timestamps='us', allow_truncated_timestamps=True)
+    buffer.seek(0)
+
+    __client_bg.load_table_from_file(buffer,
+                                     f'{project}.{dataset}.{table_name.lower()}',
+                                     job_config=__job_config).result()
+
+
+def save_parquet_file(path,
+                      project,
+                      dataset,
+                      table_name,
+                      write_disposition='WRITE_TRUNCATE'
+                    ):
+    """Save parquet file to biguquery table"""
+    __client_bg = get_bq_client(project)
+    __job_config = LoadJobConfig(source_format=SourceFormat.PARQUET,
+                                 write_disposition=write_disposition
+                            )
 
-    __client_bg.load_table_from_dataframe(df,
-                                          f'{project}.{dataset}.{table_name.lower()}',
-                                          job_config=__job_config).result()
+    with open(path, 'rb') as parquet_file:
+        __client_bg.load_table_from_file(parquet_file,
+                                         f'{project}.{dataset}.{table_name.lower()}',
+                                         job_config=__job_config).result()
 
 
 def execute_query_bigquery(project, query):
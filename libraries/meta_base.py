@@ -0,0 +1,388 @@
+import requests
+from requests.adapters import HTTPAdapter
+from abc import ABC, abstractmethod
+import orjson
+import asyncio
+import httpx
+from urllib.parse import urlencode
+import pandas as pd
+import pyarrow as pa
+from libraries.utils import (default_logger, load_country_config, fast_normalize, flatten_newlines,
+                             get_json_async, get_token_bucket, to_relative_url,
+                             get_graph_cache, graph_cache_key, graph_cache_ttl, with_paging_token,
+                             is_page_limit_error, is_rate_limit_error, lower_page_limit, page_limit_of,
+                             with_page_limit, GRAPH_API_URL, GRAPH_BATCH_SIZE, GRAPH_BATCH_MAX_ATTEMPTS,
+                             GRAPH_RATE_LIMIT_PENALTY, PAGE_LIMITS)
+from libraries.bq_utils import save_table, save_parquet_file
+from libraries.parquet_utils import ParquetSink, conform_to_schema
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+SUB_COMMENTS_SCHEMA = pa.schema([
+    ("comment_parent_id", pa.string()),
+    ("id", pa.string()),
+    ("created_time", pa.timestamp("us", tz="UTC")),
+    ("is_hidden", pa.bool_()),
+    ("is_private", pa.bool_()),
+    ("like_count", pa.int64()),
+    ("message", pa.string()),
+    ("user_likes", pa.bool_()),
+])
+
+class MetaBase(ABC):
+    """
+    Shared logic of the Facebook classes whose posts have comments: configuration, HTTP session,
+    cached and batched Graph API calls, comment streaming to Parquet and saving to BigQuery.
+
+    Subclasses set the class attributes below and implement get_comment_post_ids and get_tables.
+
+    Attributes:
+        tmp_prefix (str): Name of the temporary directory the comments are streamed to, after the country.
+        principal_comments_schema (pa.Schema): Schema of the principal comments Parquet file.
+        comments_columns (dict): Renames applied to the principal comments before conforming them.
+        comments_table_prefix (str): Name of the comments tables, between the country and '_comments'.
+        access_token (str): The access token for Facebook API.
+        account_id (str): The Facebook account ID.
+        page_id (str): The Facebook page ID.
+        country (str): The country code.
+        principal_comments_path (str): Parquet file the principal comments are streamed to.
+        sub_comments_path (str): Parquet file the sub-comments are streamed to.
+    """
+
+    tmp_prefix = None
+    principal_comments_schema = None
+    comments_columns = {}
+    comments_table_prefix = None
+
+    def __init__(self, country = None) -> None:
+        """
+        Initializes the class with configuration based on the specified country.
+
+        Args:
+            country (str): The country code to fetch configuration for.
+
+        Raises:
+            ValueError: If META_COUNTRY_CONFIG environment variable is missing or if
+                        the specified country is not in the configuration.
+        """
+
+        country_config = load_country_config()
+
+        # Verifica si el país está en la configuración
+        if country not in country_config:
+            raise ValueError(f"Configuration for country '{country}' is not defined in COUNTRY_CONFIG.")
+
+        # Selecciona la configuración basada en el país
+        config = country_config[country]
+
+        self.access_token = config.get("access_token")
+        self.account_id = config.get("account_id")
+        self.page_id = config.get("page_id")
+        self.country = country
+        # Lowered when Facebook rejects the page size of a comments request
+        self.comments_limit = PAGE_LIMITS[0]
+
+        # Keep-alive connections reused by every request to the Facebook API
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=0))
+
+        # Comments are streamed to Parquet files in this directory while they are fetched
+        self._tmp_dir = tempfile.mkdtemp(prefix=f"{self.country}_{self.tmp_prefix}_")
+        self.principal_comments_path = os.path.join(self._tmp_dir, "principal_comments.parquet")
+        self.sub_comments_path = os.path.join(self._tmp_dir, "sub_comments.parquet")
+
+        default_logger.info(f"\tCountry set with {self.country}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the HTTP session used to call the Facebook API and removes the streamed Parquet files.
+        """
+
+        self._session.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    @abstractmethod
+    def get_comment_post_ids(self):
+        """
+        Gets the IDs of the posts whose comments get_all_comments fetches.
+
+        Returns:
+            list: The unique post IDs.
+        """
+
+    @abstractmethod
+    def get_tables(self):
+        """
+        Gets the DataFrames fn_save_data saves next to the comment tables.
+
+        Returns:
+            dict: The DataFrames keyed by BigQuery table name.
+        """
+
+    def get_comments_params(self):
+        """
+        Builds the query parameters used to fetch the comments of a post.
+
+        Returns:
+            dict: The query parameters for the comments edge of the Facebook API.
+        """
+
+        return {
+            "access_token": self.access_token,
+            # Only the columns of principal_comments_schema and, inside comments{...}, of
+            # SUB_COMMENTS_SCHEMA; anything else is dropped by conform_to_schema anyway
+            "fields": (
+                "id,created_time,message,comment_count,like_count,is_hidden,permalink_url"
+                ",comments{id,created_time,is_hidden,is_private,like_count,message,user_likes}"
+            ),
+            "limit": self.comments_limit,
+        }
+
+    async def _graph_batch(self, session, relative_urls):
+        """
+        Sends up to GRAPH_BATCH_SIZE GET requests to the Facebook API in a single HTTP call.
+
+        Args:
+            session (httpx.AsyncClient): The HTTP/2 client shared by all the requests.
+            relative_urls (list): The relative urls of the requests, e.g. '<post_id>/comments?...'.
+
+        Returns:
+            list: One response per relative url, each with its 'code' and JSON encoded 'body',
+                  or None when that request timed out on Facebook's side.
+        """
+
+        data = {
+            "access_token": self.access_token,
+            "include_headers": "false",
+            "batch": orjson.dumps([{"method": "GET", "relative_url": url} for url in relative_urls]).decode(),
+        }
+
+        return await get_json_async(session, GRAPH_API_URL, method="POST", data=data, tokens=len(relative_urls))
+
+    def _write_comments(self, comments_sink, sub_comments_sink, comments, sub_comments):
+        """
+        Cleans a round of fetched comments and appends them to their Parquet files.
+
+        Args:
+            comments_sink (ParquetSink): Where the principal comments are written.
+            sub_comments_sink (ParquetSink): Where the sub-comments are written.
+            comments (list): The principal comments, as returned by the Facebook API.
+            sub_comments (list): The sub-comments, already flattened to one dict per row.
+        """
+
+        if comments:
+            df = conform_to_schema(fast_normalize(comments).rename(columns=self.comments_columns), comments_sink.schema)
+            df['message'] = flatten_newlines(df['message'])
+            comments_sink.write(df)
+
+        if sub_comments:
+            df = conform_to_schema(pd.DataFrame(sub_comments), sub_comments_sink.schema)
+            df['message'] = flatten_newlines(df['message'])
+            sub_comments_sink.write(df)
+
+    async def _fetch_comments_async(self, session, semaphore, post_ids, comments_sink, sub_comments_sink, seen_ids):
+        """
+        Fetches every page of comments for a group of posts through the batch endpoint.
+
+        Each round sends the pending request of every post in one batch and queues the
+        paging.next of each response into the following round, until no post has more pages.
+        A request that times out inside the batch is sent again with a smaller page size, and one
+        that is throttled is sent again once the TokenBucket of the access token has been
+        penalized, up to GRAPH_BATCH_MAX_ATTEMPTS times in total. Pages found in the graph cache are
+        served from disk instead. The comments of each round are written to the sinks before
+        the next one starts.
+
+        Args:
+            session (httpx.AsyncClient): The HTTP/2 client shared by all the requests.
+            semaphore (asyncio.Semaphore): Caps how many batches are in flight at the same time.
+            post_ids (list): Up to GRAPH_BATCH_SIZE post IDs to fetch comments for.
+            comments_sink (ParquetSink): Where the principal comments, tagged with their post_id, are written.
+            sub_comments_sink (ParquetSink): Where the sub-comments, tagged with their comment_parent_id, are written.
+            seen_ids (set): IDs of the principal comments already written, shared by all the groups.
+        """
+
+        async with semaphore:
+            params = {k: v for k, v in self.get_comments_params().items() if k != "access_token"}
+            # Each pending request carries how many times it has timed out or been throttled inside a batch
+            pending = [(post_id, f"{post_id}/comments?{urlencode(params)}", 0) for post_id in post_ids]
+
+            while pending:
+                # Pages already in the graph cache are left out of the batch
+                queued = []
+                pages = []
+                for post_id, url, attempts in pending:
+                    body = get_graph_cache().get(graph_cache_key(url))
+                    if body is None:
+                        queued.append((post_id, url, attempts))
+                    else:
+                        pages.append((post_id, url, body))
+                pending = []
+                responses = []
+                comments = []
+                sub_comments = []
+
+                if queued:
+                    try:
+                        responses = await self._graph_batch(session, [url for _, url, _ in queued])
+                    except httpx.HTTPError as http_error:
+                        default_logger.error("Error in batch of %d posts, the error was %s", len(queued), http_error)
+
+                for (post_id, url, attempts), response in zip(queued, responses):
+                    if response is None:
+                        # Timed out inside the batch, send it again in the next round asking for less data
+                        if attempts + 1 >= GRAPH_BATCH_MAX_ATTEMPTS:
+                            default_logger.error("Error in post_id: %s, the request timed out %d times",
+                                                 post_id, attempts + 1)
+                            continue
+
+                        limit = lower_page_limit(page_limit_of(url))
+                        pending.append((post_id, with_page_limit(url, limit) if limit else url, attempts + 1))
+                        continue
+
+                    try:
+                        body = orjson.loads(response["body"])
+                    except orjson.JSONDecodeError:
+                        default_logger.error("Error in post_id: %s, the response was not JSON", post_id)
+                        continue
+
+                    if response["code"] != 200:
+                        error_info = body.get("error", {})
+
+                        if is_rate_limit_error(error_info):
+                            # Hold off every request of the token, then send it again in the next round
+                            get_token_bucket(self.access_token).penalize(GRAPH_RATE_LIMIT_PENALTY)
+
+                            if attempts + 1 >= GRAPH_BATCH_MAX_ATTEMPTS:
+                                default_logger.error("Error in post_id: %s, the request was throttled %d times",
+                                                     post_id, attempts + 1)
+                            else:
+                                default_logger.warning("Rate limit hit for post_id: %s, retrying it", post_id)
+                                pending.append((post_id, url, attempts + 1))
+                            continue
+
+                        limit = lower_page_limit(page_limit_of(url)) if is_page_limit_error(error_info) else None
+
+                        if limit:
+                            default_logger.warning("Page size rejected for post_id: %s, retrying with %s", post_id, limit)
+                            self.comments_limit = min(self.comments_limit, limit)
+                            pending.append((post_id, with_page_limit(url, limit), attempts))
+                            continue
+
+                        default_logger.error("Error in post_id: %s, the error was %s", post_id, error_info.get('message'))
+                        continue
+
+                    # The access token in paging.next is not written to disk, to_relative_url drops it anyway
+                    get_graph_cache().set(graph_cache_key(url), with_paging_token(body, None),
+                                          expire=graph_cache_ttl(url))
+                    pages.append((post_id, url, body))
+
+                for post_id, url, body in pages:
+                    for c in body["data"]:
+                        # A repeated comment also repeats its sub-comments, both are skipped
+                        if c['id'] in seen_ids:
+                            continue
+                        seen_ids.add(c['id'])
+
+                        c['post_id'] = post_id
+                        for sc in c.pop('comments', {}).get('data', []):
+                            sub_comments.append({
+                                'comment_parent_id': c['id'],
+                                'id': sc.get('id'),
+                                'created_time': sc.get('created_time'),
+                                'is_hidden': sc.get('is_hidden'),
+                                'is_private': sc.get('is_private'),
+                                'like_count': sc.get('like_count'),
+                                'message': sc.get('message'),
+                                'user_likes': sc.get('user_likes'),
+                            })
+                        comments.append(c)
+
+                    next_url = body.get("paging", {}).get("next")
+                    if next_url:
+                        pending.append((post_id, to_relative_url(next_url), 0))
+
+                self._write_comments(comments_sink, sub_comments_sink, comments, sub_comments)
+
+    async def _fetch_all_comments_async(self, post_ids, comments_sink, sub_comments_sink, max_concurrency=20):
+        """
+        Fetches the comments of all the given posts in concurrent batches.
+
+        Args:
+            post_ids (list): The post IDs to fetch comments for.
+            comments_sink (ParquetSink): Where the principal comments are written.
+            sub_comments_sink (ParquetSink): Where the sub-comments are written.
+            max_concurrency (int, optional): Maximum number of batches in flight at the same time.
+        """
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        seen_ids = set()
+        # HTTP/2 multiplexes the concurrent batches over a few connections to graph.facebook.com
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        chunks = [post_ids[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(post_ids), GRAPH_BATCH_SIZE)]
+
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=httpx.Timeout(30, read=120)) as session:
+            await asyncio.gather(*[self._fetch_comments_async(session, semaphore, chunk,
+                                                              comments_sink, sub_comments_sink, seen_ids)
+                                   for chunk in chunks])
+
+    def get_all_comments(self):
+        """
+        Retrieves all comments for the posts of get_comment_post_ids, fetching the posts in concurrent
+        batches, and streams the principal comments and their sub-comments to separate Parquet files.
+        """
+
+        default_logger.info(f"\tTrying to get all comments")
+
+        try:
+
+            post_ids = self.get_comment_post_ids()
+
+            with ParquetSink(self.principal_comments_path, self.principal_comments_schema) as comments_sink, \
+                 ParquetSink(self.sub_comments_path, SUB_COMMENTS_SCHEMA) as sub_comments_sink:
+                asyncio.run(self._fetch_all_comments_async(post_ids, comments_sink, sub_comments_sink))
+
+            default_logger.info(f"\tPrincipal comments rows written {comments_sink.num_rows}")
+            default_logger.info(f"\tSub comments rows written {sub_comments_sink.num_rows}")
+
+        except Exception:
+            default_logger.exception("\tComment fetch failed")  # Otros errores
+
+    def fn_save_data(self):
+        """
+        Saves the DataFrames of get_tables and the streamed comment files to BigQuery tables.
+        """
+
+        default_logger.info("\tSaving data on BigQuery")
+
+        PROJECT = os.getenv("BQ_PROJECT")
+        DATASET = 'meta_comments'
+        TABLE_NAME_COMMENTS = f'{self.country}_{self.comments_table_prefix}_comments'
+        TABLE_NAME_SUBCOMMENTS = f'{self.country}_{self.comments_table_prefix}_sub_comments'
+
+        try:
+
+            jobs = {table_name: (save_table, {"df": df}) for table_name, df in self.get_tables().items()}
+            jobs[TABLE_NAME_COMMENTS] = (save_parquet_file, {"path": self.principal_comments_path})
+            jobs[TABLE_NAME_SUBCOMMENTS] = (save_parquet_file, {"path": self.sub_comments_path})
+
+            # Each load job mostly waits on BigQuery, so all of them run at the same time
+            with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                futures = {executor.submit(save, project=PROJECT, dataset=DATASET, table_name=table_name, **kwargs): table_name
+                           for table_name, (save, kwargs) in jobs.items()}
+
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as err:
+                        default_logger.error(f"\tError saving {futures[future]}: {err}")  # Otros errores
+
+        except Exception as err:
+            default_logger.error(f"\tError saving data: {err}")  # Otros errores
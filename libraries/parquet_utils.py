@@ -0,0 +1,74 @@
+"""Libraries for streaming DataFrames to Parquet files"""
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from libraries.utils import parse_graph_datetime
+
+
+def _pandas_dtype(arrow_type):
+    """Pandas dtype a column is cast to before being written as arrow_type"""
+
+    if pa.types.is_integer(arrow_type):
+        return "int64"
+    if pa.types.is_boolean(arrow_type):
+        return "bool"
+
+    return "string"
+
+
+def conform_to_schema(df, schema):
+    """
+    Select and cast the columns of df to an arrow schema.
+
+    Missing columns are added empty, integer columns default to 0 and
+    timestamp columns are parsed as Graph API timestamps.
+    """
+
+    timestamps = [field.name for field in schema if pa.types.is_timestamp(field.type)]
+    integers = [field.name for field in schema if pa.types.is_integer(field.type)]
+
+    df = (df.reindex(columns=schema.names)
+            .fillna({name: 0 for name in integers})
+            .astype({field.name: _pandas_dtype(field.type) for field in schema if field.name not in timestamps}))
+
+    for name in timestamps:
+        df[name] = parse_graph_datetime(df[name])
+
+    return df
+
+
+class ParquetSink:
+    """
+    Appends DataFrames to a Parquet file one chunk at a time, so a table never
+    has to be held in memory as a whole.
+
+    Attributes:
+        path (str): The Parquet file being written.
+        schema (pa.Schema): The schema every chunk is written with.
+        num_rows (int): The number of rows written so far.
+    """
+
+    def __init__(self, path, schema) -> None:
+        self.path = path
+        self.schema = schema
+        self.num_rows = 0
+        # Microseconds, the precision BigQuery TIMESTAMP columns store
+        self._writer = pq.ParquetWriter(path, schema, coerce_timestamps="us", allow_truncated_timestamps=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def write(self, df):
+        """Write a DataFrame already conformed to the schema as a new row group"""
+
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self._writer.write_table(table)
+        self.num_rows += table.num_rows
+
+    def close(self):
+        """Close the file, it can be loaded once closed"""
+
+        self._writer.close()
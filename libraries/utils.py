@@ -1,21 +1,57 @@
 import logging
+import logging.handlers
 import unicodedata
 import uuid
 from globack_utils.globack.util.secret_manager import Secrets
 import os
 import requests
+import pandas as pd
 import time
-from functools import wraps
+import random
+import threading
+import asyncio
+import httpx
+import hashlib
+import orjson
+import base64
+from diskcache import Cache
+from functools import wraps, lru_cache
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 __secrets_sellers = None
 
+GRAPH_API_URL = "https://graph.facebook.com/v20.0"
+GRAPH_BATCH_SIZE = 50  # Maximum number of requests accepted by the batch endpoint
+GRAPH_BATCH_MAX_ATTEMPTS = 4  # Times a request that keeps timing out or being throttled inside a batch is sent
+PAGE_LIMITS = (500, 250, 100)  # Page sizes tried in order until Facebook accepts one
+GRAPH_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"  # e.g. 2024-05-01T13:45:00+0000
+GRAPH_FIRST_PAGE_TTL = 600  # First pages get new items as they are published
+GRAPH_PAGE_TTL = 86400  # Older pages barely change
+GRAPH_CACHE_DIR = os.getenv("GRAPH_CACHE_DIR", "./.graph_cache")  # Where get_graph_cache keeps the fetched pages
+GRAPH_RATE = float(os.getenv("GRAPH_RATE_PER_SECOND", 5))  # Requests per second allowed for each access token
+GRAPH_BURST = int(os.getenv("GRAPH_RATE_BURST", 20))  # Requests that can be sent at once after being idle
+GRAPH_RATE_LIMIT_CODES = (4, 17, 32, 613, 80004)  # Graph API error codes of a throttled app, user, page or token
+GRAPH_RETRY_STATUS_CODES = (400, 429, 500, 503)  # Statuses retry_on_rate_limit may retry, 400 only when throttled
+GRAPH_RATE_LIMIT_PENALTY = 60  # Seconds every caller holds off after a throttled response
+GRAPH_BACKOFF_CAP = 900  # Longest wait between two retries, in seconds
+GRAPH_TIMEOUT = 30  # Seconds a synchronous Graph API request may take
+LOG_BUFFER_CAPACITY = 1000  # Log records kept in memory before they are written to the log file
+
+_NEWLINES = str.maketrans({"\n": " ", "\r": " "})
+
+_token_buckets = {}
+_token_buckets_lock = threading.Lock()
+
 def setup_logger(name, log_file, level=logging.INFO):
     """Function to set up a logger with the given name, log file, and level."""
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # The thread name tells apart the countries that main runs at the same time
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s')
     
-    # File handler
+    # File handler, buffered so a burst of records costs one write instead of one per record.
+    # Records of level ERROR and above flush right away, the rest is flushed on exit.
     file_handler = logging.FileHandler(log_file)        
     file_handler.setFormatter(formatter)
+    buffered_file_handler = logging.handlers.MemoryHandler(LOG_BUFFER_CAPACITY, target=file_handler)
     
     # Console handler
     console_handler = logging.StreamHandler()
@@ -25,7 +61,7 @@ def setup_logger(name, log_file, level=logging.INFO):
     logger.setLevel(level)
     
     # Add handlers to the logger
-    logger.addHandler(file_handler)
+    logger.addHandler(buffered_file_handler)
     logger.addHandler(console_handler)
 
     return logger
@@ -64,29 +100,397 @@ def get_secrets_sellers() -> dict:
 
     return __secrets_sellers
 
+def parse_json(response):
+    """Parse the body of a requests response with orjson, a faster drop-in for response.json()"""
+
+    return orjson.loads(response.content)
+
+@lru_cache(maxsize=1)
+def load_country_config() -> dict:
+    """
+    Decodes the META_COUNTRY_CONFIG environment variable once per process.
+
+    Returns:
+        dict: The configuration of every country, keyed by country code.
+
+    Raises:
+        ValueError: If META_COUNTRY_CONFIG environment variable is missing.
+    """
+
+    # Obtén la configuración del país desde la variable de entorno codificada en Base64
+    encoded_config = os.getenv("META_COUNTRY_CONFIG")
+
+    if not encoded_config:
+        raise ValueError("META_COUNTRY_CONFIG environment variable is missing.")
+
+    # Decodifica la configuración y la convierte en un diccionario
+    return orjson.loads(base64.b64decode(encoded_config))
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every request made with the same access token.
+
+    Callers reserve a token under the lock and sleep outside of it until the token is due,
+    so threads and asyncio tasks are spaced on the same schedule instead of all firing
+    (and getting throttled) together.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reserve(self, tokens=1):
+        """Take tokens and get the seconds to wait until they are due"""
+
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            # A negative balance is the queue of callers waiting for their token
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        time.sleep(self._reserve(tokens))
+
+    async def acquire_async(self, tokens=1):
+        await asyncio.sleep(self._reserve(tokens))
+
+    def penalize(self, seconds):
+        """Hold off every caller for at least seconds after Facebook throttles the token"""
+
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+def get_token_bucket(access_token):
+    """Get the TokenBucket shared by all the requests made with access_token"""
+
+    with _token_buckets_lock:
+        if access_token not in _token_buckets:
+            _token_buckets[access_token] = TokenBucket(GRAPH_RATE, GRAPH_BURST)
+
+        return _token_buckets[access_token]
+
+def access_token_of(url, params=None, data=None):
+    """Get the access token of a Graph API request, a paging url carries it in its query"""
+
+    return ((params or {}).get('access_token')
+            or (data or {}).get('access_token')
+            or dict(parse_qsl(urlsplit(url).query)).get('access_token'))
+
+def backoff_delay(retry_count, initial_backoff, cap=GRAPH_BACKOFF_CAP):
+    """Exponential backoff with jitter, so throttled callers do not all retry at the same moment"""
+
+    return min(cap, initial_backoff * 2 ** retry_count) * random.uniform(0.5, 1.5)
+
+def is_rate_limit_response(response):
+    """Check if a requests response was throttled by the Graph API"""
+
+    if response.status_code == 429:
+        return True
+
+    # Graph API errors, throttling included, come back as 400, any other body (e.g. an HTML
+    # error page) is not worth parsing
+    if response.status_code != 400:
+        return False
+
+    try:
+        error_code = parse_json(response).get('error', {}).get('code')
+    except orjson.JSONDecodeError:
+        return False
+
+    return error_code in GRAPH_RATE_LIMIT_CODES
+
+def is_rate_limit_error(error_info):
+    """Check if a Graph API error was caused by a throttled app, user, page or access token"""
+
+    return error_info.get('code') in GRAPH_RATE_LIMIT_CODES
+
+def graph_get(session, url, params=None):
+    """GET a Graph API url once the TokenBucket of its access token allows it"""
+
+    bucket = get_token_bucket(access_token_of(url, params))
+    bucket.acquire()
+
+    response = session.get(url, params=params, timeout=GRAPH_TIMEOUT)
+    if response.status_code >= 400 and is_rate_limit_response(response):
+        bucket.penalize(GRAPH_RATE_LIMIT_PENALTY)
+
+    return response
+
 def retry_on_rate_limit(max_retries=5, initial_backoff=60):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            retry_count = 0
-            backoff_time = initial_backoff
-            
-            while retry_count < max_retries:
+            for retry_count in range(max_retries):
                 try:
                     return func(*args, **kwargs)
                 except requests.exceptions.HTTPError as http_err:
-                    if http_err.response is not None:
-                        error_info = http_err.response.json()
-                        error_code = error_info.get('error', {}).get('code')
-                        if error_code == 80004:  # Rate limit error code
-                            default_logger.warning(f"Rate limit hit. Retrying in {backoff_time} seconds...")
-                            time.sleep(backoff_time)
-                            backoff_time *= 2  # Exponential backoff
-                            retry_count += 1
-                        else:
-                            raise http_err
-                    else:
-                        raise http_err
-            raise Exception(f"Max retries exceeded for {func.__name__}")
+                    response = http_err.response
+
+                    # Only throttled responses and transient server errors are worth retrying
+                    if response is None or response.status_code not in GRAPH_RETRY_STATUS_CODES:
+                        raise
+
+                    if response.status_code < 500 and not is_rate_limit_response(response):
+                        raise
+
+                    # The last error is raised as is, so callers handle it like any other HTTPError
+                    if retry_count == max_retries - 1:
+                        default_logger.error("Max retries exceeded for %s", func.__name__)
+                        raise
+
+                    backoff_time = backoff_delay(retry_count, initial_backoff)
+                    default_logger.warning(f"Rate limit hit. Retrying in {backoff_time:.0f} seconds...")
+                    time.sleep(backoff_time)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+class GraphAPIError(httpx.HTTPError):
+    """A Graph API request that could not be completed, e.g. retries ran out or the body is not JSON"""
+
+
+def is_json_response(response):
+    """Check if a requests or httpx response carries a JSON body, error pages are often HTML"""
+
+    return "application/json" in response.headers.get("content-type", "")
+
+
+def graph_error_of(response):
+    """Get the Graph API error of a response, empty when its body is not a JSON error"""
+
+    if not is_json_response(response):
+        return {}
+
+    try:
+        return orjson.loads(response.content).get('error', {})
+    except orjson.JSONDecodeError:
+        return {}
+
+
+async def get_json_async(session, url, params=None, method="GET", data=None, max_retries=5, initial_backoff=60,
+                         tokens=1):
+    """
+    Async counterpart of retry_on_rate_limit for a single Graph API request.
+
+    Every attempt waits for tokens of the TokenBucket of the access token, a batch request
+    costs one per sub-request since Facebook counts each of them. Retries with jittered
+    exponential backoff on 429, 5xx and rate limit error code responses, any other error
+    is raised as httpx.HTTPStatusError with the API message. Running out of retries or
+    getting a body that is not JSON raises GraphAPIError, so every failure of a request
+    is an httpx.HTTPError.
+    """
+
+    bucket = get_token_bucket(access_token_of(url, params, data))
+
+    for retry_count in range(max_retries):
+        await bucket.acquire_async(tokens)
+
+        response = await session.request(method, url, params=params, data=data)
+
+        if response.status_code >= 500:
+            throttled = False
+        elif response.status_code == 429:
+            throttled = True
+        elif response.status_code < 400:
+            try:
+                return orjson.loads(response.content)
+            except orjson.JSONDecodeError as json_error:
+                raise GraphAPIError(f"Invalid JSON from {url.split('?')[0]}: {json_error}") from json_error
+        else:
+            error_info = graph_error_of(response)
+            throttled = is_rate_limit_error(error_info)
+            if not throttled:
+                raise httpx.HTTPStatusError(error_info.get('message', f"HTTP {response.status_code}"),
+                                            request=response.request,
+                                            response=response)
+
+        if throttled:
+            # The other tasks sharing the token stop too instead of burning quota on retries
+            bucket.penalize(GRAPH_RATE_LIMIT_PENALTY)
+
+        backoff_time = backoff_delay(retry_count, initial_backoff)
+        default_logger.warning(f"Rate limit hit. Retrying in {backoff_time:.0f} seconds...")
+        await asyncio.sleep(backoff_time)
+
+    raise GraphAPIError(f"Max retries exceeded for {url.split('?')[0]}")
+
+
+def to_relative_url(url):
+    """Turn an absolute Graph API url (e.g. paging.next) into a batch relative_url"""
+
+    parts = urlsplit(url)
+    # Drop the leading version segment, the batch endpoint is already versioned
+    path = parts.path.lstrip('/').split('/', 1)[-1]
+    # The batch call carries the access token, so it is left out of the sub-request
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != 'access_token'])
+
+    return f"{path}?{query}" if query else path
+
+
+def is_page_limit_error(error_info):
+    """Check if a Graph API error was caused by asking for a page size that is too large"""
+
+    message = error_info.get('message', '').lower()
+    # 1: "Please reduce the amount of data...", 100: invalid 'limit' parameter
+    return error_info.get('code') in (1, 100) and ('limit' in message or 'reduce the amount of data' in message)
+
+
+def get_with_page_limit(session, url, params):
+    """GET the first page of an edge, stepping down PAGE_LIMITS while Facebook rejects the page size"""
+
+    for limit in PAGE_LIMITS:
+        response = graph_get(session, url, {**params, "limit": limit})
+
+        if response.status_code != 400 or not is_page_limit_error(graph_error_of(response)):
+            break
+
+        default_logger.warning(f"Page size {limit} rejected for {url}, retrying with a smaller one")
+
+    return response
+
+
+async def get_with_page_limit_async(session, url, params):
+    """Async counterpart of get_with_page_limit, returns the JSON payload of the first page"""
+
+    for limit in PAGE_LIMITS:
+        try:
+            return await get_json_async(session, url, {**params, "limit": limit})
+        except httpx.HTTPStatusError as http_error:
+            error_info = graph_error_of(http_error.response)
+            if limit == PAGE_LIMITS[-1] or not is_page_limit_error(error_info):
+                raise
+
+        default_logger.warning(f"Page size {limit} rejected for {url}, retrying with a smaller one")
+
+
+def lower_page_limit(limit):
+    """Next smaller page size of PAGE_LIMITS, None when limit is already the smallest"""
+
+    return next((smaller for smaller in PAGE_LIMITS if smaller < limit), None)
+
+
+def page_limit_of(relative_url):
+    """Get the page size requested by a relative_url"""
+
+    return int(dict(parse_qsl(relative_url.partition('?')[2])).get('limit', PAGE_LIMITS[-1]))
+
+
+def with_page_limit(relative_url, limit):
+    """Rewrite the page size requested by a relative_url"""
+
+    path, _, query = relative_url.partition('?')
+    params = dict(parse_qsl(query))
+    params['limit'] = limit
+
+    return f"{path}?{urlencode(params)}"
+
+
+@lru_cache(maxsize=1)
+def get_graph_cache():
+    """Open the on-disk cache of Graph API pages the first time it is needed, not on import"""
+
+    # Cached pages hold comment texts, only the user running the job can read them
+    os.makedirs(GRAPH_CACHE_DIR, mode=0o700, exist_ok=True)
+
+    return Cache(GRAPH_CACHE_DIR)
+
+
+def with_paging_token(payload, access_token):
+    """
+    Copy of a Graph API page whose paging.next carries access_token, or no token at all when it is None.
+
+    Pages are cached without the token Graph puts in paging.next, and get it back when they are served.
+    """
+
+    next_url = payload.get('paging', {}).get('next')
+    if not next_url:
+        return payload
+
+    parts = urlsplit(next_url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != 'access_token']
+    if access_token:
+        query.append(('access_token', access_token))
+
+    return {**payload, 'paging': {**payload['paging'], 'next': urlunsplit(parts._replace(query=urlencode(query)))}}
+
+
+def graph_cache_key(url, params=None):
+    """Key of a Graph API request in the graph cache"""
+
+    raw = url if params is None else f"{url}?{urlencode(sorted(params.items()))}"
+
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def graph_cache_ttl(url):
+    """Seconds a Graph API page is kept in the graph cache, shorter for the first page of an edge"""
+
+    return GRAPH_PAGE_TTL if 'after' in dict(parse_qsl(urlsplit(url).query)) else GRAPH_FIRST_PAGE_TTL
+
+
+def cached_get(session, url, params=None):
+    """
+    GET a Graph API url as JSON, serving it from the graph cache when it was already fetched.
+
+    A paging url is requested as is, the first page of an edge goes through get_with_page_limit.
+    """
+
+    key = graph_cache_key(url, params)
+    graph_cache = get_graph_cache()
+    payload = graph_cache.get(key)
+
+    if payload is None:
+        response = get_with_page_limit(session, url, params) if params else graph_get(session, url)
+        response.raise_for_status()
+        payload = with_paging_token(parse_json(response), None)
+        graph_cache.set(key, payload, expire=graph_cache_ttl(url))
+
+    # Fresh and cached pages get the same paging.next, so the next page has the same cache key
+    return with_paging_token(payload, access_token_of(url, params))
+
+
+def fast_normalize(records, sep='.'):
+    """
+    Flatten a list of JSON records into a DataFrame, a faster pd.json_normalize for shallow payloads.
+
+    Only dict values are descended into, lists (e.g. adcreatives.data, comments.data)
+    are stored verbatim as object cells under their dotted key.
+    """
+
+    flat_records = []
+
+    for record in records:
+        flat = {}
+        stack = [('', record)]
+
+        while stack:
+            prefix, node = stack.pop()
+            for key, value in node.items():
+                if isinstance(value, dict):
+                    stack.append((f"{prefix}{key}{sep}", value))
+                else:
+                    flat[f"{prefix}{key}"] = value
+
+        flat_records.append(flat)
+
+    return pd.DataFrame.from_records(flat_records)
+
+
+def parse_graph_datetime(values):
+    """Parse Graph API timestamps to UTC datetimes with the explicit format, skipping format inference"""
+
+    return pd.to_datetime(values, format=GRAPH_DATETIME_FORMAT, utc=True, cache=True)
+
+
+def flatten_newlines(values):
+    """Replace line breaks with spaces in a Series of texts using str.translate, no regex involved"""
+
+    return values.map(lambda text: text.translate(_NEWLINES) if isinstance(text, str) else text)
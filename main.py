@@ -5,6 +5,10 @@ from libraries.utils import default_logger
 import datetime as dt
 import pandas as pd
 from libraries.sentry import sentry_setup
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+COUNTRIES = ['CO', 'MX']
 
 
 def get_facebook_ads_comments(country):
@@ -14,19 +18,17 @@ def get_facebook_ads_comments(country):
     Args:
         country (str): The country code for which to extract Facebook Ads comments.
 
-    This function creates an instance of the Ads class, retrieves ads data, extracts ad creatives,
-    fetches all comments, extracts sub-comments, cleans the data, and saves it.
+    This function creates an instance of the Ads class, retrieves ads data along with their ad creatives,
+    fetches all comments along with their sub-comments, cleans the data, and saves it.
     """
 
     default_logger.info("Extracting Facebook Add's comments")
 
-    adsObject = ads_class.Ads(country)
-    adsObject.get_all_ads()
-    adsObject.fn_extract_adcreatives()
-    adsObject.get_all_comments()
-    adsObject.fn_extract_sub_comments()
-    adsObject.fn_clean_data()
-    adsObject.fn_save_data()
+    with ads_class.Ads(country) as adsObject:
+        adsObject.get_all_ads()
+        adsObject.get_all_comments()
+        adsObject.fn_clean_data()
+        adsObject.fn_save_data()
 
 def get_facebook_post_comments(country):
     """
@@ -36,17 +38,16 @@ def get_facebook_post_comments(country):
         country (str): The country code for which to extract Facebook Feed Post comments.
 
     This function creates an instance of the FeedPost class, retrieves feed post data,
-    fetches all comments, extracts sub-comments, cleans the data, and saves it.
+    fetches all comments along with their sub-comments, cleans the data, and saves it.
     """
 
     default_logger.info("Extracting Facebook Feed Post's comments")
 
-    feedObjet = feedpost_class.FeedPost(country=country)
-    feedObjet.get_all_feed_post()
-    feedObjet.get_all_comments()
-    feedObjet.fn_extract_sub_comments()
-    feedObjet.fn_clean_data()
-    feedObjet.fn_save_data()
+    with feedpost_class.FeedPost(country=country) as feedObjet:
+        feedObjet.get_all_feed_post()
+        feedObjet.get_all_comments()
+        feedObjet.fn_clean_data()
+        feedObjet.fn_save_data()
 
 def get_instagram_comments(country):
     """
@@ -61,40 +62,47 @@ def get_instagram_comments(country):
 
     default_logger.info("Extracting Instagram Media's comments")
 
-    igMediaObj = media.InstragramMedia(country=country)
+    with media.InstragramMedia(country=country) as igMediaObj:
+        igMediaObj.get_all_media_items()
+        igMediaObj.get_all_comments()
+        igMediaObj.fn_extract_replies()
+        igMediaObj.fn_clean_data()
+        igMediaObj.fn_save_data()
 
-    igMediaObj.get_all_media_items()
-    igMediaObj.get_all_comments()
-    igMediaObj.fn_extract_replies()
-    igMediaObj.fn_clean_data()
-    igMediaObj.fn_save_data()
+def run_country(country):
+    """
+    Extracts the Facebook Ads, Facebook Feed Post and Instagram Media comments of a country.
 
-@sentry_setup  
-def main():
+    Args:
+        country (str): The country code for which to extract the comments.
+    """
+
+    # Every log line of this country carries its code as the thread name
+    threading.current_thread().name = country
 
     start_process = dt.datetime.now()
 
-    """
-        Get CO comments
-    """
-    default_logger.info("Gathering the whole CO data")
+    default_logger.info(f"Gathering the whole {country} data")
 
-    get_facebook_ads_comments(country='CO')
-    get_facebook_post_comments(country="CO")
-    get_instagram_comments(country="CO")
+    get_facebook_ads_comments(country=country)
+    get_facebook_post_comments(country=country)
+    get_instagram_comments(country=country)
 
     end_process = dt.datetime.now()
 
-    default_logger.info(f"CO process duration: {end_process - start_process}")
+    default_logger.info(f"{country} process duration: {end_process - start_process}")
+
+@sentry_setup  
+def main():
+
+    start_process = dt.datetime.now()
 
     """
-        Get MX comments
+        Get CO and MX comments at the same time, they share no data
     """
-    default_logger.info("Gathering the whole MX data")
-    
-    get_facebook_ads_comments(country='MX')
-    get_facebook_post_comments(country="MX")
-    get_instagram_comments(country="MX")
+    with ThreadPoolExecutor(max_workers=len(COUNTRIES)) as executor:
+        # Consuming the results re-raises the first error of any country
+        list(executor.map(run_country, COUNTRIES))
 
     end_process = dt.datetime.now()
 